@@ -386,26 +386,29 @@ find_common_args = {
     '/',
 }
 
-reserved_tokens = {
+reserved_tokens = frozenset({
     '+',
     ';',
     '{}'
-}
+})
 
-right_associate_unary_logic_operators = {
+right_associate_unary_logic_operators = frozenset({
     '!',
     '-not'
-}
+})
 
-left_associate_unary_logic_operators = {
+left_associate_unary_logic_operators = frozenset({
     '-prune'
-}
+})
 
-binary_logic_operators = {
+unary_logic_operators = right_associate_unary_logic_operators | \
+                        left_associate_unary_logic_operators
+
+binary_logic_operators = frozenset({
     '-and',
     '-or',
     '||',
     '&&',
     '-o',
     '-a'
-}
+})
@@ -1,6 +1,9 @@
-import collections
+try:
+    from collections.abc import Mapping, MutableSet
+except ImportError:
+    from collections import Mapping, MutableSet
 
-class typedset(collections.MutableSet):
+class typedset(MutableSet):
     def __init__(self, type_, iterable=[]):
         self._s = set()
         self._type = type_
@@ -48,7 +51,7 @@ class typedset(collections.MutableSet):
     def __repr__(self):
         return self._s.__repr__()
 
-class frozendict(collections.Mapping):
+class frozendict(Mapping):
     def __init__(self, *args, **kwargs):
         self.__dict = dict(*args, **kwargs)
         self.__hash = None
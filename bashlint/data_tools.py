@@ -7,6 +7,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import sys
 
 if sys.version_info > (3, 0):
@@ -26,21 +27,18 @@ def get_utility_statistics(utility):
 
 
 def get_utilities(ast):
-    def get_utilities_fun(node):
-        utilities = set([])
+    utilities = set([])
+    if not ast:
+        return utilities
+    stack = [ast]
+    while stack:
+        node = stack.pop()
         if node.is_utility():
             utilities.add(node.value)
-            for child in node.children:
-                utilities = utilities.union(get_utilities_fun(child))
-        elif not node.is_argument():
-            for child in node.children:
-                utilities = utilities.union(get_utilities_fun(child))
-        return utilities
-
-    if not ast:
-        return set([])
-    else:
-        return get_utilities_fun(ast)
+        # utilities do not occur in the subtree of an argument
+        if not node.is_argument():
+            stack.extend(node.children)
+    return utilities
 
 
 def bash_tokenizer(cmd, recover_quotation=True, loose_constraints=False,
@@ -69,6 +67,210 @@ def bash_parser(cmd, recover_quotation=True, verbose=False):
         return ast
 
 
+# --- AST token emitters --- #
+
+# Options of ast2tokens, passed to every token emitter.
+TokenizerOptions = collections.namedtuple('TokenizerOptions', [
+    'loose_constraints', 'ignore_flag_order', 'arg_type_only',
+    'keep_common_args', 'with_arg_type', 'with_flag_head', 'with_flag_argtype',
+    'with_prefix', 'indexing_args'])
+
+# An emitter appends the tokens a node opens with to "tokens" and pushes
+# onto "stack" what follows them, in reverse order: child nodes still to be
+# expanded and literal tokens (separators and closing brackets).
+
+def _emit_root(node, tokens, stack, opts):
+    assert(opts.loose_constraints or node.get_num_of_children() == 1)
+    if opts.loose_constraints:
+        stack.extend(reversed(node.children))
+    else:
+        stack.append(node.children[0])
+
+def _emit_pipeline(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    children = node.children
+    n = len(children)
+    assert(lc or n > 1)
+    if lc and n < 1:
+        tokens.append("|")
+    else:
+        # a "singleton-pipe" is treated as atomic command
+        stack.append(children[-1])
+        for i in xrange(n - 2, -1, -1):
+            stack.append("|")
+            stack.append(children[i])
+
+def _emit_commandsubstitution(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    n = len(node.children)
+    assert(lc or n == 1)
+    tokens.append("$(")
+    stack.append(")")
+    if not (lc and n < 1):
+        stack.append(node.children[0])
+
+def _emit_processsubstitution(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    n = len(node.children)
+    assert(lc or n == 1)
+    tokens.append(node.value + "(")
+    stack.append(")")
+    if not (lc and n < 1):
+        stack.append(node.children[0])
+
+def _emit_utility(node, tokens, stack, opts):
+    token = node.value
+    if opts.with_prefix:
+        token = node.prefix + token
+    tokens.append(token)
+    children = sorted(node.children, key=lambda x:x.value) \
+        if opts.ignore_flag_order else node.children
+    stack.extend(reversed(children))
+
+def _emit_flag(node, tokens, stack, opts):
+    assert(opts.loose_constraints or node.parent)
+    if '::' in node.value and (node.value.startswith('-exec') or
+                               node.value.startswith('-ok')):
+        value, op = node.value.split('::')
+        token = value
+        if op == ';':
+            op = "\\;"
+        stack.append(op)
+    else:
+        token = node.value
+    if opts.with_flag_head:
+        if node.parent:
+            token = node.utility.value + "@@" + token
+        else:
+            token = token
+    if opts.with_prefix:
+        token = node.prefix + token
+    if opts.with_flag_argtype:
+        suffix = []
+        for child in node.children:
+            if child.is_argument():
+                suffix.append(child.arg_type)
+            elif child.is_utility():
+                suffix.append('UTILITY')
+        token = token + flag_suffix + ''.join(suffix)
+    tokens.append(token)
+    stack.extend(reversed(node.children))
+
+def _emit_operator(node, tokens, stack, opts):
+    tokens.append(node.value)
+
+def _emit_binarylogicop(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    children = node.children
+    n = len(children)
+    assert(lc or n == 0)
+    if lc and n > 0:
+        stack.append(children[-1])
+        for i in xrange(n - 2, -1, -1):
+            stack.append(node.value)
+            stack.append(children[i])
+    else:
+        tokens.append(node.value)
+
+def _emit_unarylogicop(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    n = len(node.children)
+    assert(lc or n == 0)
+    if lc and n > 0:
+        if node.associate == nast.UnaryLogicOpNode.RIGHT:
+            tokens.append(node.value)
+            stack.append(node.children[0])
+        else:
+            stack.append(node.value)
+            stack.append(node.children[0])
+    else:
+        tokens.append(node.value)
+
+def _emit_bracket(node, tokens, stack, opts):
+    lc = opts.loose_constraints
+    n = len(node.children)
+    assert(lc or n >= 1)
+    if lc and n < 2:
+        stack.extend(reversed(node.children))
+    else:
+        tokens.append("\\(")
+        stack.append("\\)")
+        stack.extend(reversed(node.children))
+
+def _emit_nt(node, tokens, stack, opts):
+    assert(opts.loose_constraints or node.get_num_of_children() > 0)
+    tokens.append("(")
+    stack.append(")")
+    stack.extend(reversed(node.children))
+
+def _emit_argument(node, tokens, stack, opts):
+    assert(opts.loose_constraints or node.get_num_of_children() == 0)
+    if opts.arg_type_only and node.is_open_vocab():
+        if (opts.keep_common_args and node.parent.is_utility() and
+            node.parent.value == 'find' and node.value in bash.find_common_args):
+            # keep frequently-occurred arguments in the vocabulary
+            # TODO: define the criteria for "common args"
+            token = node.value
+        else:
+            if node.arg_type in bash.quantity_argument_types:
+                if node.value.startswith('+'):
+                    token = '+{}'.format(node.arg_type)
+                elif node.value.startswith('-'):
+                    token = '-{}'.format(node.arg_type)
+                else:
+                    token = node.arg_type
+            else:
+                token = node.arg_type
+    else:
+        token = node.value
+    if opts.with_prefix:
+        token = node.prefix + token
+    if opts.with_arg_type:
+        token = token + "_" + node.arg_type
+    if opts.indexing_args and node.to_index():
+        token = token + "-{:02d}".format(node.index)
+
+    tokens.append(token)
+    if opts.loose_constraints:
+        stack.extend(reversed(node.children))
+
+_EMIT_TOKENS = {
+    'root': _emit_root,
+    'pipeline': _emit_pipeline,
+    'commandsubstitution': _emit_commandsubstitution,
+    'processsubstitution': _emit_processsubstitution,
+    'utility': _emit_utility,
+    'flag': _emit_flag,
+    'operator': _emit_operator,
+    'binarylogicop': _emit_binarylogicop,
+    'unarylogicop': _emit_unarylogicop,
+    'bracket': _emit_bracket,
+    'nt': _emit_nt,
+    'argument': _emit_argument,
+    't': _emit_argument
+}
+
+def _to_tokens(node, opts, tokens):
+    """
+    Append the tokens of the AST rooted at node to "tokens".
+
+    Iterative DFS over the AST. The stack holds nodes still to be expanded
+    and literal tokens which are emitted once every subtree pushed above
+    them has been consumed.
+    """
+    emitters = _EMIT_TOKENS
+    Node = nast.Node
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, Node):
+            tokens.append(node)
+            continue
+        emit = emitters.get(node.kind)
+        if emit is not None:
+            emit(node, tokens, stack, opts)
+
+
 def ast2tokens(node, loose_constraints=False, ignore_flag_order=False,
                arg_type_only=False, keep_common_args=False,
                with_arg_type=False, with_flag_head=False,
@@ -94,160 +296,13 @@ def ast2tokens(node, loose_constraints=False, ignore_flag_order=False,
     if not node:
         return []
 
-    lc = loose_constraints
-
-    def to_tokens_fun(node):
-        tokens = []
-        if node.is_root():
-            assert(loose_constraints or node.get_num_of_children() == 1)
-            if lc:
-                for child in node.children:
-                    tokens += to_tokens_fun(child)
-            else:
-                tokens = to_tokens_fun(node.children[0])
-        elif node.kind == "pipeline":
-            assert(loose_constraints or node.get_num_of_children() > 1)
-            if lc and node.get_num_of_children() < 1:
-                tokens.append("|")
-            elif lc and node.get_num_of_children() == 1:
-                # treat "singleton-pipe" as atomic command
-                tokens += to_tokens_fun(node.children[0])
-            else:
-                for child in node.children[:-1]:
-                    tokens += to_tokens_fun(child)
-                    tokens.append("|")
-                tokens += to_tokens_fun(node.children[-1])
-        elif node.kind == "commandsubstitution":
-            assert(loose_constraints or node.get_num_of_children() == 1)
-            if lc and node.get_num_of_children() < 1:
-                tokens += ["$(", ")"]
-            else:
-                tokens.append("$(")
-                tokens += to_tokens_fun(node.children[0])
-                tokens.append(")")
-        elif node.kind == "processsubstitution":
-            assert(loose_constraints or node.get_num_of_children() == 1)
-            if lc and node.get_num_of_children() < 1:
-                tokens.append(node.value + "(")
-                tokens.append(")")
-            else:
-                tokens.append(node.value + "(")
-                tokens += to_tokens_fun(node.children[0])
-                tokens.append(")")
-        elif node.is_utility():
-            token = node.value
-            if with_prefix:
-                token = node.prefix + token
-            tokens.append(token)
-            children = sorted(node.children, key=lambda x:x.value) \
-                if ignore_flag_order else node.children
-            for child in children:
-                tokens += to_tokens_fun(child)
-        elif node.is_option():
-            assert(loose_constraints or node.parent)
-            if '::' in node.value and (node.value.startswith('-exec') or 
-                                       node.value.startswith('-ok')):
-                value, op = node.value.split('::')
-                token = value
-            else:
-                token = node.value
-            if with_flag_head:
-                if node.parent:
-                    token = node.utility.value + "@@" + token
-                else:
-                    token = token
-            if with_prefix:
-                token = node.prefix + token
-            if with_flag_argtype:
-                suffix = ''
-                if node.children:
-                    for child in node.children:
-                        if child.is_argument():
-                            suffix += child.arg_type
-                        elif child.is_utility():
-                            suffix += 'UTILITY'
-                token = token + flag_suffix + suffix
-            tokens.append(token)
-            for child in node.children:
-                tokens += to_tokens_fun(child)
-            if '::' in node.value and (node.value.startswith('-exec') or
-                                       node.value.startswith('-ok')):
-                if op == ';':
-                    op = "\\;"
-                tokens.append(op)
-        elif node.kind == 'operator':
-            tokens.append(node.value)
-        elif node.kind == "binarylogicop":
-            assert(loose_constraints or node.get_num_of_children() == 0)
-            if lc and node.get_num_of_children() > 0:
-                for child in node.children[:-1]:
-                    tokens += to_tokens_fun(child)
-                    tokens.append(node.value)
-                tokens += to_tokens_fun(node.children[-1])
-            else:
-                tokens.append(node.value)
-        elif node.kind == "unarylogicop":
-            assert(loose_constraints or node.get_num_of_children() == 0)
-            if lc and node.get_num_of_children() > 0:
-                if node.associate == nast.UnaryLogicOpNode.RIGHT:
-                    tokens.append(node.value)
-                    tokens += to_tokens_fun(node.children[0])
-                else:
-                    tokens += to_tokens_fun(node.children[0])
-                    tokens.append(node.value)
-            else:
-                tokens.append(node.value)
-        elif node.kind == "bracket":
-            assert(loose_constraints or node.get_num_of_children() >= 1)
-            if lc and node.get_num_of_children() < 2:
-                for child in node.children:
-                    tokens += to_tokens_fun(child)
-            else:
-                tokens.append("\\(")
-                for i in xrange(len(node.children)-1):
-                    tokens += to_tokens_fun(node.children[i])
-                tokens += to_tokens_fun(node.children[-1])
-                tokens.append("\\)")
-        elif node.kind == "nt":
-            assert(loose_constraints or node.get_num_of_children() > 0)
-            tokens.append("(")
-            for child in node.children:
-                tokens += to_tokens_fun(child)
-            tokens.append(")")
-        elif node.is_argument() or node.kind in ["t"]:
-            assert(loose_constraints or node.get_num_of_children() == 0)
-            if arg_type_only and node.is_open_vocab():
-                if (keep_common_args and node.parent.is_utility() and
-                    node.parent.value == 'find' and node.value in bash.find_common_args):
-                    # keep frequently-occurred arguments in the vocabulary
-                    # TODO: define the criteria for "common args"
-                    token = node.value
-                else:
-                    if node.arg_type in bash.quantity_argument_types:
-                        if node.value.startswith('+'):
-                            token = '+{}'.format(node.arg_type)
-                        elif node.value.startswith('-'):
-                            token = '-{}'.format(node.arg_type)
-                        else:
-                            token = node.arg_type
-                    else:
-                        token = node.arg_type
-            else:
-                token = node.value
-            if with_prefix:
-                token = node.prefix + token
-            if with_arg_type:
-                token = token + "_" + node.arg_type
-            if indexing_args and node.to_index():
-                token = token + "-{:02d}".format(node.index)
-
-            tokens.append(token)
-            if lc:
-                for child in node.children:
-                    tokens += to_tokens_fun(child)
-        return tokens
-
-    return to_tokens_fun(node)
+    opts = TokenizerOptions(loose_constraints, ignore_flag_order,
+                            arg_type_only, keep_common_args, with_arg_type,
+                            with_flag_head, with_flag_argtype, with_prefix,
+                            indexing_args)
+    tokens = []
+    _to_tokens(node, opts, tokens)
+    return tokens
 
 
 def ast2command(node, loose_constraints=False, ignore_flag_order=False):
@@ -300,28 +355,36 @@ def ast2list(node, order='dfs', _list=None, ignore_flag_order=False,
     """
     Linearize the AST.
     """
+    if _list is None:
+        _list = []
     if order == 'dfs':
-        if node.is_argument() and node.is_open_vocab() and arg_type_only:
-            token = node.arg_type
-        elif node.is_option() and with_flag_head:
-            token = node.utility.value + '@@' + node.value if node.utility \
-                else node.value
-        else:
-            token = node.value
-        if with_prefix:
-            token = node.prefix + token
-        _list.append(token)
-        if node.get_num_of_children() > 0:
-            if node.is_utility() and ignore_flag_order:
-                children = sorted(node.children, key=lambda x:x.value)
+        # the stack holds nodes to visit and the pending no-expand markers
+        # which close each non-terminal once its subtree is linearized
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if not isinstance(node, nast.Node):
+                _list.append(node)
+                continue
+            if node.is_argument() and node.is_open_vocab() and arg_type_only:
+                token = node.arg_type
+            elif node.is_option() and with_flag_head:
+                token = node.utility.value + '@@' + node.value if node.utility \
+                    else node.value
             else:
-                children = node.children
-            for child in children:
-                ast2list(child, order, _list, ignore_flag_order, arg_type_only,
-                         keep_common_args, with_flag_head, with_prefix)
-            _list.append(nast._H_NO_EXPAND)
-        else:
-            _list.append(nast._V_NO_EXPAND)
+                token = node.value
+            if with_prefix:
+                token = node.prefix + token
+            _list.append(token)
+            if node.get_num_of_children() > 0:
+                if node.is_utility() and ignore_flag_order:
+                    children = sorted(node.children, key=lambda x:x.value)
+                else:
+                    children = node.children
+                stack.append(nast._H_NO_EXPAND)
+                stack.extend(reversed(children))
+            else:
+                _list.append(nast._V_NO_EXPAND)
     return _list
 
 
@@ -411,7 +474,7 @@ def test_bash_parser():
             # print("Pruned Command Template:")
             # print(ast2template(pruned_tree, ignore_flag_order=False))
             print()
-        except EOFError as ex:
+        except EOFError:
             break
 
 
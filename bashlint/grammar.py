@@ -28,11 +28,15 @@ EOF_S = 8
 class BashGrammarState(object):
     def __init__(self, type):
         self.type = type
+        self._utility = None    # enclosing utility state, set on first lookup
 
     def get_utility(self):
+        if self._utility is not None:
+            return self._utility
         cur = self
         while (cur):
             if cur.is_utility():
+                self._utility = cur
                 return cur
             cur = cur.parent
         raise ValueError('No utility state found')
@@ -64,7 +68,6 @@ class UtilityState(BashGrammarState):
         self.compound_flag = CompoundFlagState(self)
         self.positional_arguments = []
         self.eof = EOFState()
-        self.argument_only = False
 
     def add_flag(self, flag):
         self.compound_flag.add_flag(flag)
@@ -73,13 +76,17 @@ class UtilityState(BashGrammarState):
         self.positional_arguments.append(arg)
         arg.parent = self
 
-    def next_states(self):
-        if self.argument_only:
+    def next_states(self, filled=(), argument_only=False):
+        """
+        :param filled: Argument states which have been consumed.
+        :param argument_only: If set, no more flags are accepted.
+        """
+        if argument_only:
             next_states = []
         else:
             next_states = [self.compound_flag]
         for arg_state in self.positional_arguments:
-            if not arg_state.filled or (arg_state.is_list
+            if not arg_state in filled or (arg_state.is_list
                     and arg_state.list_separator == ' '):
                 next_states.append(arg_state)
         next_states.append(self.eof)
@@ -150,7 +157,6 @@ class ArgumentState(BashGrammarState):
             the argument.
         :member no_space: No space between the argument and the flag it is
             attached to.
-        :member filled: If set, at least
         :member parent: Parent state.
         :member rsb: Right sibling state.
         """
@@ -162,7 +168,6 @@ class ArgumentState(BashGrammarState):
         self.list_separator = list_separator
         self.regex_format = regex_format
         self.no_space = no_space
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -184,7 +189,6 @@ class ArgCommandState(BashGrammarState):
     def __init__(self):
         super(ArgCommandState, self).__init__(ARG_COMMAND_S)
         self.no_space = False
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -197,7 +201,6 @@ class ExecCommandState(BashGrammarState):
         super(ExecCommandState, self).__init__(EXEC_COMMAND_S)
         self.stop_tokens = stop_tokens
         self.no_space = False
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -208,7 +211,6 @@ class ExecCommandState(BashGrammarState):
 class CommandState(BashGrammarState):
     def __init__(self):
         super(CommandState, self).__init__(COMMAND_S)
-        self.filled = False
         self.parent = None
         self.rsb = None
 
@@ -226,6 +228,10 @@ class BashGrammar(object):
         self.name2type = {}
         self.grammar = {}
         self.next_states = None     # pointer on the current position in the grammar tree
+        # The parsing status is kept here rather than in the grammar states,
+        # which are shared by all commands of the same utility.
+        self.filled = set()         # argument states which have been consumed
+        self.argument_only = False  # no more flags are accepted after "--"
 
     def allow_eof(self):
         for state in self.next_states:
@@ -241,7 +247,8 @@ class BashGrammar(object):
     def consume(self, token):
         if token in self.grammar:
             utility_state = self.grammar[token]
-            self.next_states = utility_state.next_states()
+            self.next_states = utility_state.next_states(
+                self.filled, self.argument_only)
             return True
         else:
             return False
@@ -271,7 +278,7 @@ class BashGrammar(object):
                             raise ValueError('Unexpected flag argument "{}"'.format(token))
                 else:
                     if flag_token == '--':
-                        state.parent.argument_only = True
+                        self.argument_only = True
                     else:
                         raise ValueError('Unrecognized long flag "{}"'.format(flag_token))
             elif token in state.flag_index:
@@ -295,14 +302,16 @@ class BashGrammar(object):
                         if len(token) > 2:
                             # Case 2: multiple flags specified at the same time
                             flag_list = [(flag_token, None)]
+                            flag_index = state.flag_index
                             for j in xrange(2, len(token)):
                                 flag_token = '-' + token[j]
-                                if flag_token in state.flag_index:
-                                    if not state.flag_index[flag_token].argument:
+                                flag_state = flag_index.get(flag_token)
+                                if flag_state is not None:
+                                    if not flag_state.argument:
                                         flag_list.append((flag_token, None))
                                     else:
                                         if j < len(token) - 1:
-                                            arg_state = state.flag_index[flag_token].argument
+                                            arg_state = flag_state.argument
                                             flag_list.append((flag_token, (token[j+1:], arg_state.arg_type)))
                                             break
                                         else:
@@ -330,28 +339,34 @@ class BashGrammar(object):
                         # Case 5: the token does not match any flag state
                         return None
         elif state_type == COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = state.get_utility().next_states(
+                self.filled, self.argument_only)
         elif state_type == ARG_COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = state.get_utility().next_states(
+                self.filled, self.argument_only)
         elif state_type == EXEC_COMMAND_S:
-            self.next_states = state.get_utility().next_states()
+            self.next_states = state.get_utility().next_states(
+                self.filled, self.argument_only)
         elif state_type == OPERATOR_S:
             for i, next_state in enumerate(self.next_states):
                 if next_state.is_compound_flag():
                     del(self.next_states[i])
         elif state.type == ARG_S:
-            state.filled = True
+            self.filled.add(state)
             if state.rsb:
                 # continue interpreting the next argument of the same parent state
                 self.next_states = [state.rsb]
                 return '__SAME_PARENT__'
             else:
-                self.next_states = state.get_utility().next_states()
+                self.next_states = state.get_utility().next_states(
+                    self.filled, self.argument_only)
                 return '__PARENT_CHANGE__'
 
-    def make_grammar(self, input_file):
+    def make_grammar(self, input_file, verbose=False):
         """
         Build utility grammar from man-page synopsis.
+
+        :param verbose: if set, print the number of utilities loaded.
         """
         with open(input_file, encoding='utf-8') as f:
             content = f.readlines()
@@ -381,7 +396,10 @@ class BashGrammar(object):
                 for name in names.strip()[1:-1].split(','):
                     name = name.strip()
                     if not name in self.name2type:
-                        self.name2type[name] = type
+                        # argument types are copied onto every ArgumentNode
+                        # and compared against literals; interned, these
+                        # comparisons resolve on identity
+                        self.name2type[name] = sys.intern(type)
                     else:
                         raise ValueError(
                             'Ambiguity in name type: "{}" ({} vs. {})'.format(
@@ -389,8 +407,9 @@ class BashGrammar(object):
             elif reading_synopsis:
                 self.make_utility(line)
 
-        print('Bashlint grammar set up ({} utilities)'.format(len(self.grammar)))
-        print()
+        if verbose:
+            print('Bashlint grammar set up ({} utilities)'.format(len(self.grammar)))
+            print()
 
     def make_utility(self, line):
         line = line.strip()
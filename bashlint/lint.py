@@ -22,7 +22,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import copy
+import functools
+import multiprocessing
 import os
 import re
 import sys
@@ -35,10 +36,31 @@ from bashlint.grammar import *
 # bashlex stuff
 from bashlint import bast, errors, tokenizer, bparser
 from bashlint.nast import *
+from bashlint.nast import _flatten, _unflatten
 
 from nlp_tools import constants
 
 
+_PRIN_RE = re.compile("-prin($| )")
+_SHELL_PROMPT_RE = re.compile(r"^(?:\$ )?(?:# )?(?:[$#](?=find ))?")
+_TAR_FIX_RE = re.compile(r" tar (\w)")
+
+_PARENTHESES = frozenset(['(', ')', '\\(', '\\)'])
+
+# words which may be parsed as parentheses or logic operators of "find"
+_LOGIC_OP_WORDS = _PARENTHESES | bash.unary_logic_operators | \
+                  bash.binary_logic_operators | frozenset(['-o', '-a', ','])
+
+# kinds of the first part of a bashlex word which make it a plain argument
+_ARGUMENT_PART_KINDS = frozenset(['parameter', 'tilde'])
+
+# bashlex node kinds which cannot be normalized
+_UNSUPPORTED_KINDS = frozenset([
+    'redirect', 'operator', 'compound', 'for', 'if', 'while', 'until',
+    'assignment', 'function', 'tilde', 'heredoc'
+])
+
+
 def correct_errors_and_normalize_surface(cmd):
     # special normalization for certain commands
     ## remove all "sudo"'s
@@ -92,7 +114,8 @@ def correct_errors_and_normalize_surface(cmd):
         cmd = cmd.replace('’'.decode('utf-8'), '\'')
 
     # more typo fixes
-    cmd = re.sub("-prin($| )", '-print', cmd)
+    if '-prin' in cmd:
+        cmd = _PRIN_RE.sub('-print', cmd)
     cmd = cmd.replace("/bin/echo", "echo")
     cmd = cmd.replace(" exec sed ", " -exec sed ")
     cmd = cmd.replace(" xargs -iname ", " xargs ")
@@ -102,22 +125,16 @@ def correct_errors_and_normalize_surface(cmd):
     cmd = cmd.replace(" perm", " -perm")
     cmd = cmd.replace("'-rd\\n' ", '')
 
-    ## remove shell character
-    if cmd.startswith("$ "):
-        cmd = re.sub("^\$ ", '', cmd)
-    if cmd.startswith("# "):
-        cmd = re.sub("^\# ", '', cmd)
-    if cmd.startswith("$find "):
-        cmd = re.sub("^\$find ", "find ", cmd)
-    if cmd.startswith("#find "):
-        cmd = re.sub("^\#find ", "find ", cmd)
+    ## remove shell character: "$ ", "# ", "$find " and "#find " prompts,
+    ## stripped in this order
+    if cmd.startswith(('$', '#')):
+        cmd = cmd[_SHELL_PROMPT_RE.match(cmd).end():]
 
     ## the first argument of "tar" is always interpreted as an option
-    tar_fix = re.compile(' tar \w')
     if cmd.startswith('tar'):
         cmd = ' ' + cmd
-    for w in re.findall(tar_fix, cmd):
-        cmd = cmd.replace(w, w.replace(' tar ', ' tar -'))
+    if ' tar ' in cmd:
+        cmd = _TAR_FIX_RE.sub(r' tar -\1', cmd)
     cmd = cmd.strip()
 
     return cmd
@@ -198,25 +215,55 @@ def safe_bashlex_parse(cmd, start_pos=0, verbose=False):
         return None
     return tree
 
-def normalize_ast(cmd, recover_quotes=True, verbose=False):
+def normalize_ast(cmd, recover_quotes=True, verbose=False, use_cache=True):
     """
     Convert the bashlex parse tree of a command into the normalized form.
 
+    Unless verbose is set, results are cached by command; every call returns
+    a fresh copy of the cached tree which the caller is free to modify. Use
+    clear_normalize_cache() to release the cached trees.
+
     :param cmd: bash command to parse
     :param recover_quotes: if set, retain quotation marks in the command
     :param verbose: if set, print error message.
+    :param use_cache: if not set, always parse the command again.
     :return normalized_tree
     """
+    if verbose or not use_cache:
+        # verbose calls bypass the cache so that their messages are printed
+        # every time
+        return _normalize_ast(cmd, recover_quotes, verbose)
+    normalized_tree = _cached_normalize_ast(cmd, recover_quotes)
+    if normalized_tree is None:
+        return None
+    return normalized_tree.clone()
+
+@functools.lru_cache(maxsize=10000)
+def _cached_normalize_ast(cmd, recover_quotes):
+    return _normalize_ast(cmd, recover_quotes, False)
+
+def clear_normalize_cache():
+    """
+    Release the trees cached by normalize_ast.
+    """
+    _cached_normalize_ast.cache_clear()
+
+def _normalize_ast(cmd, recover_quotes, verbose):
     cmd = cmd.replace('\n', ' ').strip()
     cmd = correct_errors_and_normalize_surface(cmd)
     if not cmd:
         return None
 
+    # bind module-level constants used for every token of the command
+    unary_logic_operators = bash.unary_logic_operators
+    binary_logic_operators = bash.binary_logic_operators
+    parentheses = _PARENTHESES
+    logic_op_words = _LOGIC_OP_WORDS
+
     def is_unary_logic_op(node, parent):
         if node.word == "!":
             return parent and parent.is_command("find")
-        return node.word in bash.right_associate_unary_logic_operators \
-               or node.word in bash.left_associate_unary_logic_operators
+        return node.word in unary_logic_operators
 
     def is_binary_logic_op(node, parent):
         if node.word == '-o':
@@ -237,21 +284,21 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 return True
             else:
                 return False
-        return node.word in bash.binary_logic_operators
+        return node.word in binary_logic_operators
 
     def is_parenthesis(node, parent):
-        if node.word in ['(', ')', '\\(', '\\)']:
+        if node.word in parentheses:
             if parent and parent.is_command('find'):
                 return True
             else:
                 return False
 
-    def recover_node_quotes(node):
-        return cmd[node.pos[0] : node.pos[1]]
-
     def normalize_word(node, recover_quotes=True):
-        w = recover_node_quotes(node) if recover_quotes else node.word
-        return w
+        # a word is a slice of the command, which retains its quotes
+        if recover_quotes:
+            start, end = node.pos
+            return cmd[start:end]
+        return node.word
 
     def normalize_argument(node, current, arg_type):
         value = normalize_word(node, recover_quotes)
@@ -282,7 +329,7 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 current.add_child(head)
 
             # If utility grammar is not known, parse into a simple two-level tree
-            if not bg.consume(token):
+            if not token in bg.grammar:
                 raise errors.LintParsingError(
                     "Warning: grammar not found - utility {}".format(token), num_tokens, 0)
                 for bast_node in input[1:]:
@@ -301,7 +348,7 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 return
 
             current, i = head, 1
-            bash_grammar.grammar = {head.value: copy.deepcopy(bg.grammar[head.value])}
+            bash_grammar.grammar = {head.value: bg.grammar[head.value]}
             bash_grammar.consume(head.value)
 
             while i < len(input):
@@ -322,21 +369,24 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                                 bast_node.word.startswith('-') and
                                     bast_node.parts[0].kind == 'parameter')):
                             continue
-                        if is_parenthesis(bast_node, current):
+                        # a single lookup rules out parentheses and logic
+                        # operators for ordinary flags
+                        maybe_op = bast_node.word in logic_op_words
+                        if maybe_op and is_parenthesis(bast_node, current):
                             flag = FlagNode(bast_node.word, parent=current,
                                             lsb=current.get_right_child())
                             current.add_child(flag)
                             matched = True
                             i += 1
                             break
-                        elif is_unary_logic_op(bast_node, current):
+                        elif maybe_op and is_unary_logic_op(bast_node, current):
                             flag = UnaryLogicOpNode(bast_node.word, parent=current,
                                                     lsb=current.get_right_child())
                             current.add_child(flag)
                             matched = True
                             i += 1
                             break
-                        elif is_binary_logic_op(bast_node, current):
+                        elif maybe_op and is_binary_logic_op(bast_node, current):
                             flag = BinaryLogicOpNode(bast_node.word, parent=current,
                                                      lsb=current.get_right_child())
                             current.add_child(flag)
@@ -390,16 +440,12 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                                 normalize(bast_node, current, 'command')
                                 i += 1
                         elif next_state.type == EXEC_COMMAND_S:
-                            new_input = []
+                            stop_tokens = next_state.stop_tokens
                             j = i
-                            while j < len(input):
-                                if hasattr(input[j], 'word') and \
-                                        input[j].word in next_state.stop_tokens:
-                                    break
-                                else:
-                                    new_input.append(input[j])
-                                    j += 1
-                            new_command_node.parts = new_input
+                            while j < len(input) and \
+                                    getattr(input[j], 'word', None) not in stop_tokens:
+                                j += 1
+                            new_command_node.parts = input[i:j]
                             normalize_command(new_command_node, current)
                             if j < len(input):
                                 current.value += ('::' + input[j].word)
@@ -485,9 +531,12 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
         def pop_stack_content(depth, rparenth, stack_top=None):
             # popping pushed states off the stack
             popped = stack.pop()
+            buffer = []
             while (popped.value != "("):
-                head.remove_child(popped)
+                buffer.append(popped)
                 popped = stack.pop()
+            if buffer:
+                head.remove_children(buffer)
             lparenth = popped
             if not rparenth:
                 # unbalanced brackets
@@ -503,23 +552,27 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                 stack.append(new_child)
             return depth, i
 
+        push = stack.append
+        # the children list is re-read only after it has been modified
+        children = head.children
+        n = len(children)
         i = 0
-        while i < head.get_num_of_children():
-            child = head.children[i]
+        while i < n:
+            child = children[i]
             if child.value == "(":
-                stack.append(child)
+                push(child)
                 depth += 1
             elif child.value == ")":
-                assert(depth >= 0)
                 # fix imbalanced parentheses: missing '('
                 if depth == 0:
                     # simply drop the single ')'
                     detach_from_tree(child, child.parent)
                 else:
                     depth, i = pop_stack_content(depth, child)
-            else:
-                if depth > 0:
-                    stack.append(child)
+                children = head.children
+                n = len(children)
+            elif depth > 0:
+                push(child)
 
             i += 1
 
@@ -615,108 +668,99 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
                         sub_command.children.append(repl_str_node2)
                         break
 
-    def normalize(node, current, arg_type=""):
-        # recursively normalize each subtree
-        if not type(node) is bast.node:
-            raise ValueError('type(node) is not bast.node')
-        if node.kind == 'word':
-            # assign fine-grained types
-            if node.parts:
-                # Compound arguments
-                # commandsubstitution, processsubstitution, parameter
-                if node.parts[0].kind == "processsubstitution":
-                    if '>' in node.word:
-                        norm_node = ProcessSubstitutionNode('>')
-                        attach_to_tree(norm_node, current)
-                        for child in node.parts:
-                            normalize(child, norm_node)
-                    elif '<' in node.word:
-                        norm_node = ProcessSubstitutionNode('<')
-                        attach_to_tree(norm_node, current)
-                        for child in node.parts:
-                            normalize(child, norm_node)
-                elif node.parts[0].kind == "commandsubstitution":
-                    norm_node = CommandSubstitutionNode()
+    # The handlers below do not recurse into the parts of a bashlex node:
+    # they push them onto the work stack of normalize as (node, attach point,
+    # argument type) items, in reverse order so that they are attached in
+    # their original order.
+
+    def push_parts(work, parts, current):
+        for i in xrange(len(parts) - 1, -1, -1):
+            work.append((parts[i], current, ""))
+
+    def normalize_word_node(node, current, arg_type, work):
+        # assign fine-grained types
+        if node.parts:
+            # Compound arguments
+            # commandsubstitution, processsubstitution, parameter
+            part_kind = node.parts[0].kind
+            if part_kind == "processsubstitution":
+                if '>' in node.word:
+                    norm_node = ProcessSubstitutionNode('>')
                     attach_to_tree(norm_node, current)
-                    for child in node.parts:
-                        normalize(child, norm_node)
-                elif (node.parts[0].kind == "parameter" or
-                      node.parts[0].kind == "tilde"):
-                    normalize_argument(node, current, arg_type)
-                else:
-                    for child in node.parts:
-                        normalize(child, current)
-            else:
+                    push_parts(work, node.parts, norm_node)
+                elif '<' in node.word:
+                    norm_node = ProcessSubstitutionNode('<')
+                    attach_to_tree(norm_node, current)
+                    push_parts(work, node.parts, norm_node)
+            elif part_kind == "commandsubstitution":
+                norm_node = CommandSubstitutionNode()
+                attach_to_tree(norm_node, current)
+                push_parts(work, node.parts, norm_node)
+            elif part_kind in _ARGUMENT_PART_KINDS:
                 normalize_argument(node, current, arg_type)
-        elif node.kind == "pipeline":
-            norm_node = PipelineNode()
-            attach_to_tree(norm_node, current)
-            if len(node.parts) % 2 == 0:
-                raise ValueError("Error: pipeline node must have odd number of parts (%d)"
-                      % len(node.parts))
-            for child in node.parts:
-                if child.kind == "command":
-                    normalize(child, norm_node)
-                elif not child.kind == "pipe":
-                    raise ValueError(
-                        "Error: unrecognized type of child of pipeline node")
-        elif node.kind == "list":
-            if len(node.parts) > 2:
-                # multiple commands, not supported
-                raise ValueError("Unsupported: list of length >= 2")
             else:
-                normalize(node.parts[0], current)
-        elif node.kind == "commandsubstitution" or \
-             node.kind == "processsubstitution":
-            normalize(node.command, current)
-        elif node.kind == "command":
-            try:
-                normalize_command(node, current)
-            except AssertionError:
-                raise AssertionError("normalized_command AssertionError")
-        elif hasattr(node, 'parts'):
-            for child in node.parts:
+                push_parts(work, node.parts, current)
+        else:
+            normalize_argument(node, current, arg_type)
+
+    def normalize_pipeline(node, current, arg_type, work):
+        norm_node = PipelineNode()
+        attach_to_tree(norm_node, current)
+        if len(node.parts) % 2 == 0:
+            raise ValueError("Error: pipeline node must have odd number of parts (%d)"
+                  % len(node.parts))
+        commands = []
+        for child in node.parts:
+            if child.kind == "command":
+                commands.append(child)
+            elif not child.kind == "pipe":
+                raise ValueError(
+                    "Error: unrecognized type of child of pipeline node")
+        push_parts(work, commands, norm_node)
+
+    def normalize_list(node, current, arg_type, work):
+        if len(node.parts) > 2:
+            # multiple commands, not supported
+            raise ValueError("Unsupported: list of length >= 2")
+        else:
+            work.append((node.parts[0], current, ""))
+
+    def normalize_substitution(node, current, arg_type, work):
+        work.append((node.command, current, ""))
+
+    def normalize_command_node(node, current, arg_type, work):
+        normalize_command(node, current)
+
+    # handlers of the bashlex node kinds which are supported
+    handlers = {
+        'word': normalize_word_node,
+        'pipeline': normalize_pipeline,
+        'list': normalize_list,
+        'commandsubstitution': normalize_substitution,
+        'processsubstitution': normalize_substitution,
+        'command': normalize_command_node
+    }
+
+    def normalize(node, current, arg_type=""):
+        # normalize the subtree rooted at node with an explicit work stack;
+        # the whole subtree is attached to current when this returns
+        work = [(node, current, arg_type)]
+        while work:
+            node, current, arg_type = work.pop()
+            if not type(node) is bast.node:
+                raise ValueError('type(node) is not bast.node')
+            handler = handlers.get(node.kind)
+            if handler is not None:
+                handler(node, current, arg_type, work)
+            elif hasattr(node, 'parts'):
                 # skip current node
-                normalize(child, current)
-        elif node.kind == "redirect":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "operator":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "parameter":
-            # not supported
-            raise ValueError("Unsupported: parameters")
-        elif node.kind == "compound":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "list":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "for":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "if":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "while":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "until":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "assignment":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "function":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "tilde":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
-        elif node.kind == "heredoc":
-            # not supported
-            raise ValueError("Unsupported: %s" % node.kind)
+                push_parts(work, node.parts, current)
+            elif node.kind == "parameter":
+                # not supported
+                raise ValueError("Unsupported: parameters")
+            elif node.kind in _UNSUPPORTED_KINDS:
+                # not supported
+                raise ValueError("Unsupported: %s" % node.kind)
 
     tree = safe_bashlex_parse(cmd, verbose=verbose)
     if tree is None:
@@ -725,27 +769,13 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
     normalized_tree = Node(kind="root")
     try:
         normalize(tree[0], normalized_tree)
-    except ValueError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except AttributeError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except AssertionError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except errors.SubCommandError as err:
-        if verbose:
-            print("%s - %s" % (err.args[0], cmd))
-        return None
-    except errors.LintParsingError as err:
+    except AssertionError:
+        # failed sanity checks of normalize_command, which carry no message
         if verbose:
-            print("%s - %s" % (err.args[0], cmd))
+            print("normalized_command AssertionError - %s" % cmd)
         return None
-    except errors.FlagError as err:
+    except (ValueError, AttributeError, errors.SubCommandError,
+            errors.LintParsingError, errors.FlagError) as err:
         if verbose:
             print("%s - %s" % (err.args[0], cmd))
         return None
@@ -757,6 +787,43 @@ def normalize_ast(cmd, recover_quotes=True, verbose=False):
 
     return normalized_tree
 
+def normalize_batch(cmds, workers=None, recover_quotes=True, verbose=False):
+    """
+    Normalize a list of commands in parallel using a pool of processes.
+
+    :param cmds: bash commands to parse
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param recover_quotes: if set, retain quotation marks in the command
+    :param verbose: if set, print error message.
+    :return list of normalized trees, in the same order as cmds; None for
+        the commands that could not be normalized
+    """
+    cmds = list(cmds)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # a few chunks per worker amortize the IPC cost while keeping the load
+    # balanced
+    chunksize = max(1, len(cmds) // (workers * 4))
+    pool = multiprocessing.Pool(workers)
+    try:
+        flat_trees = pool.map(functools.partial(_normalize_flat,
+                                                recover_quotes=recover_quotes,
+                                                verbose=verbose),
+                              cmds, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+    return [_unflatten(records) if records is not None else None
+            for records in flat_trees]
+
+def _normalize_flat(cmd, recover_quotes, verbose):
+    # trees are sent back from the workers flattened, as pickle would
+    # otherwise recurse along the sibling links of long commands
+    normalized_tree = normalize_ast(cmd, recover_quotes, verbose)
+    if normalized_tree is None:
+        return None
+    return _flatten(normalized_tree)
+
 def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
     if not node:
         return ''
@@ -774,10 +841,11 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
             else:
                 str += to_command_fun(node.get_left_child())
         elif node.kind == 'pipeline':
-            assert(loose_constraints or node.get_num_of_children() > 1)
-            if lc and node.get_num_of_children() < 1:
+            n = len(node.children)
+            assert(loose_constraints or n > 1)
+            if lc and n < 1:
                 str += ''
-            elif lc and node.get_num_of_children() == 1:
+            elif lc and n == 1:
                 str += to_command_fun(node.get_left_child())
             else:
                 for child in node.children[:-1]:
@@ -785,16 +853,18 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
                     str += ' | '
                 str += to_command_fun(node.get_right_child())
         elif node.kind == "commandsubstitution":
-            assert(loose_constraints or node.get_num_of_children() == 1)
-            if lc and node.get_num_of_children() < 1:
+            n = len(node.children)
+            assert(loose_constraints or n == 1)
+            if lc and n < 1:
                 str += ''
             else:
                 str += '$('
                 str += to_command_fun(node.get_left_child())
                 str += ')'
         elif node.kind == 'processsubstitution':
-            assert(loose_constraints or node.get_num_of_children() == 1)
-            if lc and node.get_num_of_children() < 1:
+            n = len(node.children)
+            assert(loose_constraints or n == 1)
+            if lc and n < 1:
                 str += ''
             else:
                 str += '{}('.format(node.value)
@@ -826,8 +896,9 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
         elif node.kind == 'operator':
             str += '--'
         elif node.kind == "binarylogicop":
-            assert(loose_constraints or node.get_num_of_children() == 0)
-            if lc and node.get_num_of_children() > 0:
+            n = len(node.children)
+            assert(loose_constraints or n == 0)
+            if lc and n > 0:
                 for child in node.children[:-1]:
                     str += to_command_fun(child) + ' '
                     str += node.value + ' '
@@ -836,8 +907,9 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
             else:
                 str += node.value
         elif node.kind == "unarylogicop":
-            assert(loose_constraints or node.get_num_of_children() == 0)
-            if lc and node.get_num_of_children() > 0:
+            n = len(node.children)
+            assert(loose_constraints or n == 0)
+            if lc and n > 0:
                 if node.associate == UnaryLogicOpNode.RIGHT:
                     str += '{} {}'.format(
                         node.value, to_command_fun(node.get_left_child()))
@@ -847,8 +919,9 @@ def serialize_ast(node, loose_constraints=False, ignore_flag_order=False):
             else:
                 str += node.value
         elif node.kind == "bracket":
-            assert(loose_constraints or node.get_num_of_children() >= 1)
-            if lc and node.get_num_of_children() < 2:
+            n = len(node.children)
+            assert(loose_constraints or n >= 1)
+            if lc and n < 2:
                 for child in node.children:
                     str += to_command_fun(child)
             else:
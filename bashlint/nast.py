@@ -11,6 +11,17 @@ _V_NO_EXPAND = '__SP__V_NO_EXPAND'
 
 KIND_PREFIX = '<KIND_PREFIX>'
 
+# argument types whose values come from a closed vocabulary
+_CLOSED_VOCAB_ARG_TYPES = frozenset([
+    'Type',
+    'Option',
+    'Format',
+    # 'Size',
+    # 'Time',
+    # 'Number',
+    # 'Permission'
+])
+
 
 def make_parent_child(parent, child):
     parent.add_child(child)
@@ -22,7 +33,76 @@ def make_sibling(lsb, rsb):
     if rsb:
         rsb.lsb = lsb
 
+# slots holding links between nodes, rebuilt by _unflatten
+_LINK_SLOTS = frozenset(['_parent', 'lsb', 'rsb', 'children', '_utility'])
+
+_state_slots_cache = {}
+
+def _state_slots(cls):
+    # names of the slots of cls that carry node attributes rather than links
+    if cls not in _state_slots_cache:
+        _state_slots_cache[cls] = tuple(
+            name for klass in cls.__mro__
+            for name in klass.__dict__.get('__slots__', ())
+            if name not in _LINK_SLOTS)
+    return _state_slots_cache[cls]
+
+def _flatten(root):
+    """
+    Flatten the subtree rooted at root into a list of (class, attributes,
+    parent index, lsb index, rsb index) records, in preorder. The list can
+    be pickled without recursing along the links between nodes; links to
+    nodes outside of the subtree are dropped.
+    """
+    nodes = []
+    parents = []
+    index = {}
+    stack = [(root, None)]
+    while stack:
+        node, parent = stack.pop()
+        index[id(node)] = len(nodes)
+        nodes.append(node)
+        parents.append(parent)
+        stack.extend((child, index[id(node)])
+                     for child in reversed(node.children))
+    records = []
+    for node, parent in zip(nodes, parents):
+        records.append((
+            node.__class__,
+            tuple(getattr(node, name) for name in _state_slots(node.__class__)),
+            parent,
+            index.get(id(node.lsb)) if node.lsb is not None else None,
+            index.get(id(node.rsb)) if node.rsb is not None else None))
+    return records
+
+def _unflatten(records):
+    """
+    Rebuild the subtree flattened by _flatten and return its root. The
+    rebuilt nodes share no mutable attribute values with the records.
+    """
+    nodes = []
+    for cls, state, parent, _, _ in records:
+        node = cls.__new__(cls)
+        node.children = []
+        node._utility = None
+        for name, value in zip(_state_slots(cls), state):
+            setattr(node, name, value)
+        node._copy_attributes()
+        if parent is None:
+            node._parent = None
+        else:
+            node._parent = nodes[parent]
+            nodes[parent].children.append(node)
+        nodes.append(node)
+    for node, (_, _, _, lsb, rsb) in zip(nodes, records):
+        node.lsb = nodes[lsb] if lsb is not None else None
+        node.rsb = nodes[rsb] if rsb is not None else None
+    return nodes[0]
+
 class Node(object):
+    __slots__ = ('_parent', 'lsb', 'rsb', 'kind', 'value', 'children',
+                 '_utility')
+
     num_child = -1          # number of children taken by node
                             # -1 indicates "any number of"
     children_types = []     # list of compatible types of children
@@ -46,12 +126,29 @@ class Node(object):
         :member value: string value of the node
         :member children: list of child nodes
         """
-        self.parent = parent
+        self.children = []
+        self._utility = None    # closest utility ancestor, set on first lookup
+        # a new node has no subtree whose cached utility could be stale, so
+        # the parent is set without going through the property setter
+        self._parent = parent
         self.lsb = lsb
         self.rsb = None
         self.kind = kind
         self.value = value
-        self.children = []
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        # the subtree may have been moved under a different utility
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._utility = None
+            stack.extend(node.children)
 
     def add_child(self, child, index=None):
         lsb = self.get_right_child()
@@ -110,32 +207,60 @@ class Node(object):
         return self.kind == "root"
 
     def remove_child(self, child):
-        if child in self.children:
+        try:
             self.children.remove(child)
+        except ValueError:
+            pass
+
+    def remove_children(self, children):
+        # remove several children with a single pass over the list
+        children = set(children)
+        self.children = [child for child in self.children
+                         if not child in children]
 
     def remove_child_by_index(self, index):
         self.children.pop(index)
 
     def replace_child(self, child, new_child):
         new_child.parent = child.parent
-        index = self.children.index(child)
-        self.remove_child(child)
-        self.children.insert(index, new_child)
-        make_sibling(child.lsb, new_child)
-        make_sibling(new_child, child.rsb)
+        self.children[self.children.index(child)] = new_child
+        new_child.lsb = child.lsb
+        new_child.rsb = child.rsb
+        if new_child.lsb:
+            new_child.lsb.rsb = new_child
+        if new_child.rsb:
+            new_child.rsb.lsb = new_child
 
     def substitute_parentheses(self, lp, rp, new_child):
         # substitute parenthese expression with single node
         assert(lp.parent == rp.parent)
         new_child.parent = rp.parent
-        make_sibling(lp.lsb, new_child)
-        make_sibling(new_child, rp.rsb)
+        # link new_child between the siblings of the parenthese pair
+        new_child.lsb = lp.lsb
+        new_child.rsb = rp.rsb
+        if new_child.lsb:
+            new_child.lsb.rsb = new_child
+        if new_child.rsb:
+            new_child.rsb.lsb = new_child
+        # overwrite lp in place so the tail of the list is shifted only once
         index = self.children.index(lp)
-        self.remove_child(lp)
+        self.children[index] = new_child
         self.remove_child(rp)
-        self.children.insert(index, new_child)
         return index
 
+    def clone(self):
+        """
+        Return a copy of the subtree rooted at this node. The copy is detached
+        from the tree; sibling links to nodes outside of the subtree are
+        dropped.
+        """
+        return _unflatten(_flatten(self))
+
+    def _copy_attributes(self):
+        # called on each node rebuilt by _unflatten; nodes whose attributes
+        # hold mutable values replace them with copies
+        pass
+
     @property
     def prefix(self):
         return self.kind.upper() + KIND_PREFIX
@@ -146,9 +271,12 @@ class Node(object):
 
     @property
     def utility(self):
+        if self._utility is not None:
+            return self._utility
         ancester = self
         while ancester is not None:
             if ancester.kind == "utility":
+                self._utility = ancester
                 return ancester
             # if no parent utility is detect, return "root"
             ancester = ancester.parent
@@ -159,10 +287,16 @@ class Node(object):
         return self.parent.parent
 
 class UtilityNode(Node):
+    __slots__ = ('arg_dict',)
+
     def __init__(self, value='', parent=None, lsb=None):
         super(UtilityNode, self).__init__(parent, lsb, "utility", value)
         self.arg_dict = {'': collections.defaultdict(int)}
 
+    def _copy_attributes(self):
+        self.arg_dict = dict((key, collections.defaultdict(int, counts))
+                             for key, counts in self.arg_dict.items())
+
     def add_child(self, child, index=None):
         super(UtilityNode, self).add_child(child)
         if child.is_argument() and not child.is_bracket():
@@ -183,18 +317,19 @@ class UtilityNode(Node):
                 return child
 
 class FlagNode(Node):
+    __slots__ = ()
+
     def __init__(self, value='', parent=None, lsb=None):
         super(FlagNode, self).__init__(parent, lsb, "flag", value)
 
     def add_child(self, child, index=None):
         super(FlagNode, self).add_child(child)
         if child.is_argument():
-            if not self.value in self.utility.arg_dict:
-                self.utility.arg_dict[self.value] \
-                    = collections.defaultdict(int)
-            self.utility.arg_dict[self.value][child.arg_type] += 1
-            child.set_index(
-                self.utility.arg_dict[self.value][child.arg_type])
+            arg_dict = self.utility.arg_dict
+            if not self.value in arg_dict:
+                arg_dict[self.value] = collections.defaultdict(int)
+            arg_dict[self.value][child.arg_type] += 1
+            child.set_index(arg_dict[self.value][child.arg_type])
 
     def get_argument(self):
         for child in self.children:
@@ -205,6 +340,8 @@ class FlagNode(Node):
         return self.value.startswith('--')
 
 class ArgumentNode(Node):
+    __slots__ = ('arg_type', 'index', 'list_separator', 'list_members')
+
     num_child = 0
 
     def __init__(self, value='', arg_type='', parent=None, lsb=None,
@@ -215,6 +352,10 @@ class ArgumentNode(Node):
         self.list_separator = list_separator
         self.list_members = list_members
 
+    def _copy_attributes(self):
+        if self.list_members is not None:
+            self.list_members = list(self.list_members)
+
     def is_bracket(self):
         return self.value == "(" or self.value == ")"
     
@@ -224,21 +365,7 @@ class ArgumentNode(Node):
     def is_open_vocab(self):
         if self.is_reserved():
             return False
-        if self.arg_type == 'Type':
-            return False
-        if self.arg_type == 'Option':
-            return False
-        if self.arg_type == 'Format':
-            return False
-        # if self.arg_type == "Size":
-        #     return False
-        # if self.arg_type == "Time":
-        #     return False
-        # if self.arg_type == "Number":
-        #     return False
-        # if self.arg_type == "Permission":
-        #     return False
-        return True
+        return not self.arg_type in _CLOSED_VOCAB_ARG_TYPES
 
     def to_index(self):
         if self.parent.kind == "utility":
@@ -250,6 +377,8 @@ class ArgumentNode(Node):
         self.index = ind
 
 class OperatorNode(Node):
+    __slots__ = ()
+
     num_child = 0
 
     def __init__(self, value='', parent=None, lsb=None):
@@ -257,6 +386,8 @@ class OperatorNode(Node):
             parent, lsb, kind='operator', value=value)
 
 class UnaryLogicOpNode(Node):
+    __slots__ = ('associate',)
+
     num_child = 1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
     LEFT = 0
@@ -272,6 +403,8 @@ class UnaryLogicOpNode(Node):
             raise ValueError("Unrecognized unary logic operator: {}".format(value))
 
 class BinaryLogicOpNode(Node):
+    __slots__ = ()
+
     num_child = -1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
 
@@ -279,6 +412,8 @@ class BinaryLogicOpNode(Node):
         super(BinaryLogicOpNode, self).__init__(parent, lsb, 'binarylogicop', value)
 
 class BracketNode(Node):
+    __slots__ = ()
+
     num_child = -1
     children_types = [set(['flag', 'bracket', 'unarylogicop', 'binarylogicop'])]
 
@@ -286,33 +421,39 @@ class BracketNode(Node):
         super(BracketNode, self).__init__(parent, lsb, 'bracket', '')
 
 class RedirectNode(Node):
+    __slots__ = ()
+
     num_child = 2
 
     def __init__(self, value='', parent=None, lsb=None):
         super(RedirectNode, self).__init__(parent, lsb, 'redirect', value)
 
 class PipelineNode(Node):
+    __slots__ = ()
+
     children_types = [set(['utility'])]
 
     def __init__(self, parent=None, lsb=None):
         super(PipelineNode, self).__init__(parent, lsb, 'pipeline')
 
 class CommandSubstitutionNode(Node):
+    __slots__ = ()
+
     num_child = 1
     children_types = [set(['pipe', 'utility'])]
 
     def __init__(self, parent=None, lsb=None):
-        super(CommandSubstitutionNode, self).__init__(parent, lsb)
-        self.kind = "commandsubstitution"
+        super(CommandSubstitutionNode, self).__init__(
+            parent, lsb, "commandsubstitution")
 
 class ProcessSubstitutionNode(Node):
+    __slots__ = ()
+
     num_child = 1
     children_types = [set(['pipe', 'utility'])]
 
     def __init__(self, value, parent=None, lsb=None):
-        super(ProcessSubstitutionNode, self).__init__(parent, lsb)
-        self.kind = "processsubstitution"
-        if value in ["<", ">"]:
-            self.value = value
-        else:
+        if not value in ("<", ">"):
             raise ValueError("Value of a processsubstitution has to be '<' or '>'.")
+        super(ProcessSubstitutionNode, self).__init__(
+            parent, lsb, "processsubstitution", value)